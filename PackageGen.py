@@ -1,12 +1,19 @@
 #!/usr/bin/env python3
 
+import filecmp
+import functools
 import io
 import json
 import os
+import re
+import resource
 import shutil
 import subprocess
 import sys
+import tempfile
+import time
 from argparse import ArgumentParser
+from contextlib import contextmanager
 from pathlib import Path
 
 
@@ -18,22 +25,52 @@ def parse_args():
     parser = ArgumentParser()
     parser.add_argument("-c", "--cql_compiler", dest="cql_compiler_path",
                         help="Path to the CQL compiler.", metavar="PATH", required=True)
+    parser.add_argument("--c_compiler", dest="c_compiler",
+                        help="C compiler used to build the query plan program.", metavar="PATH",
+                        default=os.environ.get("CC", "cc"))
+    parser.add_argument("--compact",
+                        action="store_true", dest="compact", default=False,
+                        help="Generate compact Swift code with single-line members.")
     parser.add_argument("-d", "--cgsql_sources", dest="cgsql_sources_dir",
                         help="Read CG-SQL runtime sources from this directory.", metavar="DIR", required=True)
+    parser.add_argument("-e", "--export",
+                        action="store_true", dest="export", default=False,
+                        help="Generate methods that write query results as JSON Lines or CSV.")
+    parser.add_argument("--depfile", dest="depfile", metavar="FILE",
+                        help="Write a Make-style dependency file listing the inputs of the generated package, "
+                        "and touch the stamp file OUT/NAME.stamp that it names as the target.")
     parser.add_argument("-i", "--in", dest="file_sql",
                         help="Read cg-sql input from this file", metavar="FILE", required=True)
+    parser.add_argument("-l", "--link",
+                        action="store_true", dest="link", default=False,
+                        help="Hard link source files into the package instead of copying them.")
     parser.add_argument("-o", "--out", dest="out_dir",
                         help="Directory to generate code to", metavar="DIR",
                         default="out")
     parser.add_argument("-p", "--package_name",
                         dest="package_name", metavar="NAME",
                         help="Swift Package Name", required=True)
+    parser.add_argument("-q", "--query_plan",
+                        action="store_true", dest="query_plan", default=False,
+                        help="Audit the query plan of every statement, and report table scans, "
+                        "temporary b-trees and automatic indexes.")
+    parser.add_argument("-r", "--shared_runtime", dest="shared_runtime_dir",
+                        help="Generate the CG-SQL runtime once as a Swift package in this directory, "
+                        "and make the generated package depend on it instead of copying the runtime into it.",
+                        metavar="DIR")
+    parser.add_argument("--share_row_types",
+                        action="store_true", dest="share_row_types", default=False,
+                        help="Queries with identical projections share a single row type.")
+    parser.add_argument("--size_report", dest="size_report", metavar="FILE",
+                        help="Write the generated Swift code size of each proc, in lines and bytes, to this JSON file.")
     parser.add_argument("-s", "--swift-generator", dest="swift_generator_path",
                         help="Path to the Swift code generator.", metavar="PATH", required=True)
     parser.add_argument("-t", "--test",
                         action='append',
                         dest="test_files", metavar="FILE",
                         help="Swift Package unit test file. Can be supplied multiple times.")
+    parser.add_argument("--trace", dest="trace", metavar="FILE",
+                        help="Write per-phase timing to this file in Chrome trace-event JSON format.")
     parser.add_argument("-v", "--verbose",
                         action="store_true", dest="verbose", default=False,
                         help="print verbose status messages to stdout")
@@ -43,7 +80,80 @@ def parse_args():
 
 ARGS = parse_args()
 
+TRACE_EVENTS = []
 
+
+def max_rss_bytes(who):
+    max_rss = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux.
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+@contextmanager
+def trace_phase(name, **trace_args):
+    if not ARGS.trace:
+        yield
+        return
+    # time.time() lines events up across processes; durations come from
+    # the monotonic clock so they can't be skewed by clock adjustments.
+    start_wall = time.time()
+    start_counter = time.perf_counter()
+    start_cpu = time.process_time()
+    start_times = os.times()
+    start_rss = max_rss_bytes(resource.RUSAGE_SELF)
+    start_children_rss = max_rss_bytes(resource.RUSAGE_CHILDREN)
+    try:
+        yield
+    finally:
+        end_counter = time.perf_counter()
+        end_cpu = time.process_time()
+        end_times = os.times()
+        children_cpu = (end_times.children_user + end_times.children_system) - \
+            (start_times.children_user + start_times.children_system)
+        end_rss = max_rss_bytes(resource.RUSAGE_SELF)
+        end_children_rss = max_rss_bytes(resource.RUSAGE_CHILDREN)
+        # ru_maxrss is a high-water mark over the life of the process (or of
+        # all children so far), not a per-phase value. Report it as such,
+        # along with how much this phase raised it.
+        trace_args.update({
+            'cpu_ms': round((end_cpu - start_cpu) * 1000, 3),
+            'children_cpu_ms': round(children_cpu * 1000, 3),
+            'max_rss_so_far_bytes': end_rss,
+            'max_rss_growth_bytes': end_rss - start_rss,
+            'children_max_rss_so_far_bytes': end_children_rss,
+            'children_max_rss_growth_bytes': end_children_rss - start_children_rss,
+        })
+        TRACE_EVENTS.append({
+            'name': name,
+            'cat': 'PackageGen',
+            'ph': 'X',
+            'pid': os.getpid(),
+            'tid': 0,
+            'ts': int(start_wall * 1e6),
+            'dur': int((end_counter - start_counter) * 1e6),
+            'args': trace_args,
+        })
+
+
+def traced(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with trace_phase(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def write_trace(trace_path):
+    if ARGS.verbose:
+        eprint(f'Writing trace {trace_path}')
+    events = [{'name': 'process_name', 'ph': 'M', 'pid': os.getpid(),
+               'args': {'name': 'PackageGen.py'}}]
+    events += TRACE_EVENTS
+    trace = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+    Path(trace_path).write_text(json.dumps(trace, indent=1))
+
+
+@traced
 def cql_gen_c(cql_compiler_path, file_sql, out_dir):
     if ARGS.verbose:
         eprint(f'Generating C')
@@ -56,14 +166,12 @@ def cql_gen_c(cql_compiler_path, file_sql, out_dir):
     file_h = out_dir / file_h_name
     file_c = out_dir / file_c_name
 
-    absolute_file_sql = file_sql.resolve(True)
-
     result = subprocess.run([cql_compiler_path,
-                                '--in', absolute_file_sql,
+                                '--in', file_sql.name,
                                 '--cg', file_h, file_c,
                                 '--cqlrt', 'cqlrt_cf.h',
                                 '--c_include_path', file_h_name
-                                ])
+                                ], cwd=file_sql.parent)
     if result.returncode != 0:
         raise ValueError(
             f'Could not generate c code from {file_sql}. Return code {result.returncode}')
@@ -71,6 +179,7 @@ def cql_gen_c(cql_compiler_path, file_sql, out_dir):
     return (file_h, file_c)
 
 
+@traced
 def cql_gen_objc(cql_compiler_path, file_sql, out_dir):
     if ARGS.verbose:
         eprint(f'Generating Obj-C')
@@ -83,8 +192,9 @@ def cql_gen_objc(cql_compiler_path, file_sql, out_dir):
     file_h = out_dir / file_h_name
     file_objc_h = out_dir / file_objc_h_name
 
-    result = subprocess.run([cql_compiler_path, "--in", file_sql,
-                             "--cg", file_objc_h, '--rt', 'objc_mit', '--objc_c_include_path',  file_h_name, '--cqlrt', 'cqlrt_cf.h'])
+    result = subprocess.run([cql_compiler_path, "--in", file_sql.name,
+                             "--cg", file_objc_h, '--rt', 'objc_mit', '--objc_c_include_path',  file_h_name, '--cqlrt', 'cqlrt_cf.h'],
+                            cwd=file_sql.parent)
     if result.returncode != 0:
         raise ValueError(
             f'Could not generate objc code from {file_sql}. Return code {result.returncode}')
@@ -92,6 +202,7 @@ def cql_gen_objc(cql_compiler_path, file_sql, out_dir):
     return (file_objc_h)
 
 
+@traced
 def cql_gen_json_schema(cql_compiler_path, file_sql, out_dir):
     if ARGS.verbose:
         eprint(f'Generating json')
@@ -99,8 +210,8 @@ def cql_gen_json_schema(cql_compiler_path, file_sql, out_dir):
     file_stem = file_sql.stem
     file_json = out_dir / (file_stem + ".json")
 
-    result = subprocess.run([cql_compiler_path, "--in", file_sql, "--rt",
-                             "json_schema", "--cg", file_json])
+    result = subprocess.run([cql_compiler_path, "--in", file_sql.name, "--rt",
+                             "json_schema", "--cg", file_json], cwd=file_sql.parent)
     if result.returncode != 0:
         raise ValueError(
             f'Could not generate c code from {file_sql}. Return code {result.returncode}')
@@ -108,6 +219,7 @@ def cql_gen_json_schema(cql_compiler_path, file_sql, out_dir):
     return file_json
 
 
+@traced
 def parse_json_schema(file_json):
     if ARGS.verbose:
         eprint(f'Parsing json schema')
@@ -117,128 +229,430 @@ def parse_json_schema(file_json):
     return json.loads(text)
 
 
+@traced
+def cql_gen_query_plan(cql_compiler_path, file_sql, query_plan_dir):
+    if ARGS.verbose:
+        eprint(f'Generating query plan program')
+
+    query_plan_dir.mkdir(parents=True, exist_ok=True)
+    file_query_plan_sql = query_plan_dir / "query_plan.sql"
+    # The CG-SQL query plan driver includes "query_plan.h".
+    file_h = query_plan_dir / "query_plan.h"
+    file_c = query_plan_dir / "query_plan.c"
+
+    result = subprocess.run([cql_compiler_path, "--in", file_sql.name, "--rt",
+                             "query_plan", "--cg", file_query_plan_sql], cwd=file_sql.parent)
+    if result.returncode != 0:
+        raise ValueError(
+            f'Could not generate query plan code from {file_sql}. Return code {result.returncode}')
+
+    result = subprocess.run([cql_compiler_path, "--in", file_query_plan_sql,
+                             "--cg", file_h, file_c])
+    if result.returncode != 0:
+        raise ValueError(
+            f'Could not generate c code from {file_query_plan_sql}. Return code {result.returncode}')
+
+    return file_c
+
+
+def query_plan_sources(cql_sources):
+    cql_sources = Path(cql_sources)
+    sources = [cql_sources / "query_plan_test.c", cql_sources / "cqlrt.c"]
+    # Some versions of cqlrt.c include cqlrt_common.c rather than relying
+    # on it being compiled separately.
+    if '#include "cqlrt_common.c"' not in sources[1].read_text():
+        sources.append(cql_sources / "cqlrt_common.c")
+    return sources
+
+
+@traced
+def build_query_plan(c_compiler, cql_sources, file_c, query_plan_dir):
+    if ARGS.verbose:
+        eprint(f'Building query plan program')
+
+    query_plan_exe = query_plan_dir / "query_plan"
+    result = subprocess.run([c_compiler, "-I", query_plan_dir, "-I", cql_sources,
+                             "-o", query_plan_exe, file_c] + query_plan_sources(cql_sources) + ["-lsqlite3"])
+    if result.returncode != 0:
+        raise ValueError(
+            f'Could not build query plan program {query_plan_exe}. Return code {result.returncode}')
+    return query_plan_exe
+
+
+@traced
+def run_query_plan(query_plan_exe):
+    if ARGS.verbose:
+        eprint(f'Running query plan program')
+
+    # The query plan program creates the schema in an in-memory database and
+    # prints the plan of every statement as JSON.
+    result = subprocess.run([query_plan_exe], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise ValueError(
+            f'Query plan program failed. Return code {result.returncode}\n{result.stderr}')
+    return json.loads(result.stdout)
+
+
+# Plan details that make a query slow, and why.
+QUERY_PLAN_ALERTS = [
+    ('tableScan', re.compile(r'\bSCAN\b(?!.*\b(USING|CONSTANT ROW)\b)'),
+     'table scan without an index'),
+    ('tempBTree', re.compile(r'\bUSE TEMP B-TREE\b'),
+     'temporary b-tree sort'),
+    ('automaticIndex', re.compile(r'\bAUTOMATIC\b.*\bINDEX\b'),
+     'automatic index built at query time'),
+]
+
+
+def normalize_sql(sql):
+    return ' '.join(sql.split()).lower()
+
+
+def statement_pattern(statement):
+    # Statement arguments are '?' in the json schema, but have been replaced
+    # by sample values in the query plan program.
+    parts = [re.escape(part) for part in normalize_sql(statement).split('?')]
+    return re.compile('.+?'.join(parts))
+
+
+@traced
+def audit_query_plans(query_plans, json_schema):
+    if ARGS.verbose:
+        eprint(f'Auditing query plans')
+
+    procs = []
+    for section in ["general", "inserts", "updates", "deletes", "queries"]:
+        for proc in json_schema.get(section, []):
+            if "statement" in proc:
+                procs.append(
+                    (proc["name"], statement_pattern(proc["statement"])))
+
+    report = {proc_name: [] for proc_name, _ in procs}
+    unmatched = []
+    alert_count = 0
+    for plan in query_plans.get("plans", []):
+        query = plan.get("query", "")
+        plan_lines = plan.get("plan", "")
+        if isinstance(plan_lines, str):
+            plan_lines = plan_lines.split('\n')
+        alerts = []
+        for line in plan_lines:
+            for kind, pattern, description in QUERY_PLAN_ALERTS:
+                if pattern.search(line):
+                    alerts.append({
+                        'kind': kind,
+                        'description': description,
+                        'detail': line.strip(' |.`-'),
+                    })
+        alert_count += len(alerts)
+        entry = {'query': query, 'plan': plan_lines, 'alerts': alerts}
+        matched = [proc_name for proc_name, pattern in procs
+                   if pattern.fullmatch(normalize_sql(query))]
+        for proc_name in matched:
+            report[proc_name].append(entry)
+        if not matched:
+            unmatched.append(entry)
+
+    return {
+        'procs': report,
+        'unmatched': unmatched,
+        'alertCount': alert_count,
+    }
+
+
+def format_query_plan_report(report):
+    out = io.StringIO()
+    sections = list(report['procs'].items())
+    if report['unmatched']:
+        sections.append(('(statements not matched to a proc)', report['unmatched']))
+    for proc_name, entries in sections:
+        if not entries:
+            continue
+        out.write(f'{proc_name}\n')
+        for entry in entries:
+            out.write(f'  {" ".join(entry["query"].split())}\n')
+            if not entry['alerts']:
+                out.write('    ok\n')
+            for alert in entry['alerts']:
+                out.write(f'    {alert["detail"]}: {alert["description"]}\n')
+    out.write(f'{report["alertCount"]} query plan alerts.\n')
+    return out.getvalue()
+
+
+@traced
+def gen_query_plan_report(cql_compiler_path, cgsql_sources_dir, file_sql, out_dir, json_schema):
+    file_stem = file_sql.stem
+    # The query plan program is only needed to produce the report, so it is
+    # built in a temporary directory.
+    with tempfile.TemporaryDirectory() as query_plan_dir:
+        query_plan_dir = Path(query_plan_dir)
+        file_c = cql_gen_query_plan(
+            cql_compiler_path, file_sql, query_plan_dir)
+        query_plan_exe = build_query_plan(
+            ARGS.c_compiler, cgsql_sources_dir, file_c, query_plan_dir)
+        query_plans = run_query_plan(query_plan_exe)
+    report = audit_query_plans(query_plans, json_schema)
+    text = format_query_plan_report(report)
+
+    write_if_changed(out_dir / f"{file_stem}_query_plan_report.json",
+                     json.dumps(report, indent=4) + '\n')
+    write_if_changed(out_dir / f"{file_stem}_query_plan_report.txt", text)
+    eprint(text, end='')
+
+
+@traced
 def gen_swift_package(package_name, out_dir):
-    old_cwd = os.getcwd()
-    try:
-        os.chdir(out_dir)
-        Path(package_name).mkdir(parents=True, exist_ok=True)
-        os.chdir(package_name)
-        subprocess.run(["swift", "package", "init"])
-        return (Path(out_dir) / package_name)
-    finally:
-        os.chdir(old_cwd)
+    if ARGS.verbose:
+        eprint(f'gen_swift_package {package_name}')
+    package_dir = Path(out_dir) / package_name
+    (package_dir / "Sources" / package_name).mkdir(parents=True, exist_ok=True)
+    write_if_changed(package_dir / ".gitignore", "/.build\n/.swiftpm\n")
+    return package_dir
 
 
-def update_package_swift_file(package_name, package_dir, c_lib_name, generate_test_target):
+# Define CQL_EMIT_OBJC_INTERFACES so that Swift can import the result set Obj-C class.
+OBJC_INTERFACES_SETTINGS = '            cSettings: [.define("CQL_EMIT_OBJC_INTERFACES")]),\n'
+
+
+@traced
+def gen_package_swift_file(package_name, package_dir, c_lib_name, generate_test_target, runtime_package_dir):
     if ARGS.verbose:
-        eprint(f'update_package_swift_file {package_name} {c_lib_name}')
-    package_file_path = Path(package_dir) / "Package.swift"
-    package_file_contents = package_file_path.read_text().split("\n")
-    out = []
-
-    def find_target_dependencies(target_keyword, package_name):
-        for i, line in enumerate(package_file_contents):
-            if line.strip().startswith(target_keyword):
-                if i+2 < len(package_file_contents):
-                    next_line = package_file_contents[i+1]
-                    if next_line.strip().startswith(f'name: \"{package_name}\",'):
-                        dep_line = package_file_contents[i+2]
-                        if dep_line.strip().startswith('dependencies: ['):
-                            return i+2
-        return None
-    splice_index = find_target_dependencies(".target", package_name)
-    if splice_index:
-        package_file_contents[splice_index] = package_file_contents[splice_index].replace(
-            "[])", f"[\"{c_lib_name}\"]")
-        package_file_contents.insert(
-            splice_index+1, f"            cSettings: [.define(\"CQL_EMIT_OBJC_INTERFACES\")]),")
-        package_file_contents.insert(splice_index+2, f"        .target(")
-        package_file_contents.insert(
-            splice_index+3, f"            name: \"{c_lib_name}\",")
-        package_file_contents.insert(
-            splice_index+4, f"            dependencies: [],")
-        package_file_contents.insert(
-            splice_index+5, f"            // cqlrt_common.c is included inside cqlrt_cf.c")
-        package_file_contents.insert(
-            splice_index+6, f"            exclude: [\"cqlrt_common.c\"],")
-        # Define CQL_EMIT_OBJC_INTERFACES so that Swift can import the result set Obj-C class.
-        package_file_contents.insert(
-            splice_index+7, f"            cSettings: [.define(\"CQL_EMIT_OBJC_INTERFACES\")]),")
+        eprint(f'gen_package_swift_file {package_name} {c_lib_name}')
+    # The manifest is written from a template rather than by
+    # `swift package init`, so it doesn't depend on the installed toolchain.
+    out = io.StringIO()
+    out.write('// swift-tools-version:5.5\n')
+    out.write('// Generated by PackageGen.py.\n')
+    out.write('\n')
+    out.write('import PackageDescription\n')
+    out.write('\n')
+    out.write('let package = Package(\n')
+    out.write(f'    name: "{package_name}",\n')
+    out.write('    products: [\n')
+    out.write('        .library(\n')
+    out.write(f'            name: "{package_name}",\n')
+    out.write(f'            targets: ["{package_name}"]),\n')
+    out.write('    ],\n')
+    if runtime_package_dir:
+        runtime_package_path = os.path.relpath(runtime_package_dir, package_dir)
+        out.write('    dependencies: [\n')
+        out.write(f'        .package(path: "{runtime_package_path}"),\n')
+        out.write('    ],\n')
     else:
-        raise f"Could not splice target {package_name}."
-
+        out.write('    dependencies: [],\n')
+    out.write('    targets: [\n')
+    out.write('        .target(\n')
+    out.write(f'            name: "{package_name}",\n')
+    out.write(f'            dependencies: ["{c_lib_name}"],\n')
+    out.write(OBJC_INTERFACES_SETTINGS)
+    out.write('        .target(\n')
+    out.write(f'            name: "{c_lib_name}",\n')
+    if runtime_package_dir:
+        runtime_package = Path(runtime_package_dir).name
+        out.write(
+            f'            dependencies: [.product(name: "{RUNTIME_NAME}", package: "{runtime_package}")],\n')
+    else:
+        out.write('            dependencies: [],\n')
+        out.write('            // cqlrt_common.c is included inside cqlrt_cf.c\n')
+        out.write('            exclude: ["cqlrt_common.c"],\n')
+    out.write(OBJC_INTERFACES_SETTINGS)
     if generate_test_target:
-        splice_index = find_target_dependencies(
-            ".testTarget", f"{package_name}Tests")
-        if splice_index:
-            package_file_contents[splice_index] = package_file_contents[splice_index].replace(
-                "]),", "],")
-            package_file_contents.insert(
-                splice_index+1, f"            cSettings: [.define(\"CQL_EMIT_OBJC_INTERFACES\")]),")
-        else:
-            raise f"Could not splice testTarget {package_name}."
+        out.write('        .testTarget(\n')
+        out.write(f'            name: "{package_name}Tests",\n')
+        out.write(f'            dependencies: ["{package_name}"],\n')
+        out.write(OBJC_INTERFACES_SETTINGS)
+    out.write('    ]\n')
+    out.write(')\n')
+
+    write_if_changed(Path(package_dir) / "Package.swift", out.getvalue())
+
+
+def write_if_changed(path, text):
+    # Leave files that are already up to date alone, so that regenerating a
+    # package only changes the modification times of files whose content
+    # changed. Build systems then rebuild only what depends on those.
+    path = Path(path)
+    if path.is_file() and path.read_text() == text:
+        return
+    path.write_text(text)
+
+
+def update_file(src, to_dir):
+    # Move a freshly generated file into place, unless an identical one is
+    # already there.
+    dest = Path(to_dir) / Path(src).name
+    if dest.is_file() and filecmp.cmp(src, dest, shallow=False):
+        return dest
+    shutil.move(src, dest)
+    return dest
+
+
+def remove_stale_files(directory, file_names):
+    # Regenerating in place must not leave files from an earlier run behind.
+    # For example, the runtime sources copied without --shared_runtime would
+    # otherwise be compiled a second time once CQLRuntime provides them.
+    directory = Path(directory)
+    if not directory.is_dir():
+        return
+    for path in directory.iterdir():
+        if path.is_file() and path.name not in file_names:
+            if ARGS.verbose:
+                eprint("removing ", path)
+            path.unlink()
+
+
+def copy_file(src, to_dir):
+    name = Path(src).name
+    dest = Path(to_dir) / name
+    with trace_phase('copy', file=name):
+        if dest.is_file() and (os.path.samefile(src, dest) or filecmp.cmp(src, dest, shallow=False)):
+            return
+        if ARGS.link:
+            if ARGS.verbose:
+                eprint("linking ", src, " to ", dest)
+            if dest.exists():
+                dest.unlink()
+            try:
+                os.link(src, dest)
+                return
+            except OSError:
+                # Hard links can't cross file systems; fall back to copying.
+                pass
+        if ARGS.verbose:
+            eprint("copying ", src, " to ", dest)
+        shutil.copy(src, dest)
 
-    package_file_path.write_text('\n'.join(package_file_contents))
+
+def runtime_sources(cql_sources):
+    cql_sources = Path(cql_sources)
+    return ([
+        cql_sources / "cqlrt_common.c",
+        cql_sources / "cqlrt_cf" / "cqlholder.m",
+        cql_sources / "cqlrt_cf" / "cqlrt_cf.c"
+    ], [
+        cql_sources / "cqlrt_common.h",
+        cql_sources / "cqlrt_cf" / "cqlrt_cf.h"
+    ])
+
+
+RUNTIME_NAME = "CQLRuntime"
+
+RUNTIME_PACKAGE_SWIFT = f"""// swift-tools-version:5.5
+// Generated by PackageGen.py.
+
+import PackageDescription
+
+let package = Package(
+    name: "{RUNTIME_NAME}",
+    products: [
+        .library(
+            name: "{RUNTIME_NAME}",
+            targets: ["{RUNTIME_NAME}"]),
+    ],
+    targets: [
+        .target(
+            name: "{RUNTIME_NAME}",
+            dependencies: [],
+            // cqlrt_common.c is included inside cqlrt_cf.c
+            exclude: ["cqlrt_common.c"],
+            cSettings: [.define("CQL_EMIT_OBJC_INTERFACES")]),
+    ]
+)
+"""
+
+
+@traced
+def gen_runtime_package(runtime_package_dir, cql_sources):
+    if ARGS.verbose:
+        eprint(f'gen_runtime_package {runtime_package_dir}')
+
+    # The runtime package is shared by every generated package. Files that
+    # are already up to date are left alone, because touching them would
+    # make SwiftPM rebuild the runtime for all of its dependents.
+    runtime_path = Path(runtime_package_dir) / "Sources" / RUNTIME_NAME
+    runtime_include_path = runtime_path / "include"
+    runtime_include_path.mkdir(parents=True, exist_ok=True)
+    sources, headers = runtime_sources(cql_sources)
+    for dest, files in {runtime_path: sources, runtime_include_path: headers}.items():
+        for file in files:
+            copy_file(file, dest)
+
+    write_if_changed(Path(runtime_package_dir) /
+                     "Package.swift", RUNTIME_PACKAGE_SWIFT)
 
 
-def make_c_lib(package_name, package_dir, cql_sources, file_h, file_c, file_objc_h, generate_test_target):
+@traced
+def make_c_lib(package_name, package_dir, cql_sources, file_h, file_c, file_objc_h, generate_test_target, runtime_package_dir):
     if ARGS.verbose:
         eprint(f'make_c_lib {package_name}')
 
     c_lib_name = f"lib{package_name}"
     c_lib_path = Path(package_dir) / "Sources" / c_lib_name
-    c_lib_path.mkdir()
     c_lib_include_path = c_lib_path / "include"
-    c_lib_include_path.mkdir()
-    cql_sources = Path(cql_sources)
+    c_lib_include_path.mkdir(parents=True, exist_ok=True)
 
-    def cp(src, to_dir):
-        name = Path(src).name
-        dest = Path(to_dir) / name
-        if ARGS.verbose:
-            eprint("copying ", src, " to ", dest)
-        shutil.copy(src, dest)
     copy_dict = {
-        c_lib_path: [
-            file_c,
-            cql_sources / "cqlrt_common.c",
-            cql_sources / "cqlrt_cf" / "cqlholder.m",
-            cql_sources / "cqlrt_cf" / "cqlrt_cf.c"
-        ],
-        c_lib_include_path: [
-            file_h,
-            file_objc_h,
-            cql_sources / "cqlrt_common.h",
-            cql_sources / "cqlrt_cf" / "cqlrt_cf.h"
-        ]
+        c_lib_path: [file_c],
+        c_lib_include_path: [file_h, file_objc_h]
     }
+    if not runtime_package_dir:
+        sources, headers = runtime_sources(cql_sources)
+        copy_dict[c_lib_path] += sources
+        copy_dict[c_lib_include_path] += headers
     for dest, files in copy_dict.items():
         for file in files:
-            cp(file, dest)
-    update_package_swift_file(
-        package_name, package_dir, c_lib_name, generate_test_target)
+            copy_file(file, dest)
+        remove_stale_files(dest, {Path(file).name for file in files})
+    gen_package_swift_file(
+        package_name, package_dir, c_lib_name, generate_test_target, runtime_package_dir)
     return (c_lib_name)
 
 
+@traced
 def gen_swift_target(swift_code_generator_path, json_schema_path, c_lib_name, output_file_path):
     if ARGS.verbose:
         eprint(f'Generating swift code {output_file_path}')
-    subprocess.run([swift_code_generator_path, "--input", json_schema_path,
-                   "--module", c_lib_name, "--output", output_file_path])
-
-
+    command = [swift_code_generator_path, "--input", json_schema_path,
+               "--module", c_lib_name, "--output", output_file_path]
+    if ARGS.compact:
+        command.append("--compact")
+    if ARGS.share_row_types:
+        command.append("--share_row_types")
+    if ARGS.export:
+        command.append("--export")
+    if ARGS.size_report:
+        command += ["--size_report", ARGS.size_report]
+    if not ARGS.trace:
+        subprocess.run(command)
+        return
+    # Have the Swift generator record its own phases, then merge them into
+    # our trace so the whole regeneration shows up on one timeline.
+    with tempfile.TemporaryDirectory() as temp_dir:
+        swift_trace_path = Path(temp_dir) / "SwiftGen.trace.json"
+        subprocess.run(command + ["--trace", swift_trace_path])
+        if swift_trace_path.is_file():
+            swift_trace = json.loads(swift_trace_path.read_text())
+            TRACE_EVENTS.extend(swift_trace['traceEvents'])
+
+
+@traced
 def gen_swift_test_target(package_name, package_dir, test_files):
     if ARGS.verbose:
         eprint(
             f'Generating swift test target for {package_name} files {test_files}')
+    test_name = f"{package_name}Tests"
+    test_dir = Path(package_dir) / "Tests" / test_name
+    if test_files:
+        test_dir.mkdir(parents=True, exist_ok=True)
     for test_file in test_files:
-        test_name = f"{package_name}Tests"
+        # Keep each file's name, so that several test files don't overwrite
+        # each other.
         test_file_text = Path(test_file).read_text()
-        swift_test_file = Path(package_dir) / "Tests" / \
-            test_name / f"{test_name}.swift"
-        swift_test_file.write_text(test_file_text)
+        write_if_changed(test_dir / Path(test_file).name, test_file_text)
+    remove_stale_files(test_dir, {Path(file).name for file in test_files})
 
 
+@traced
 def gen_read_me(package_name, package_dir):
     if ARGS.verbose:
         eprint(f'Generating README.md for {package_name}')
@@ -248,31 +662,57 @@ def gen_read_me(package_name, package_dir):
     out.write('A set of stored procedures. Generated by gen.py.\n')
 
     read_me_file = Path(package_dir) / "README.md"
-    read_me_file.write_text(out.getvalue())
+    write_if_changed(read_me_file, out.getvalue())
 
 
-def gen_project(swift_code_generator_path, cql_compiler_path, cgsql_sources_dir, file_sql, package_name, out_dir, test_files):
+@traced
+def gen_project(swift_code_generator_path, cql_compiler_path, cgsql_sources_dir, file_sql, package_name, out_dir, test_files, runtime_package_dir):
     if ARGS.verbose:
         eprint(f'Generating project {out_dir}')
-    # Generate the schema first because it can use relative paths,
-    # so the cql error messages are nice and short.
-    file_json_schema = cql_gen_json_schema(
-        cql_compiler_path, file_sql, out_dir)
-    file_h, file_c = cql_gen_c(cql_compiler_path, file_sql, out_dir)
-    file_objc_h = cql_gen_objc(cql_compiler_path, file_sql, out_dir)
+    # The CQL passes run in the sql file's directory and are given just its
+    # name, so the cql error messages are nice and short and the generated
+    # code doesn't depend on where the checkout lives. They write to a
+    # temporary directory, and only outputs that changed are moved into
+    # out_dir.
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = Path(temp_dir)
+        file_json_schema = cql_gen_json_schema(
+            cql_compiler_path, file_sql, temp_dir)
+        file_h, file_c = cql_gen_c(cql_compiler_path, file_sql, temp_dir)
+        file_objc_h = cql_gen_objc(cql_compiler_path, file_sql, temp_dir)
+        file_json_schema, file_h, file_c, file_objc_h = [
+            update_file(file, out_dir) for file in [file_json_schema, file_h, file_c, file_objc_h]]
     json_schema = parse_json_schema(file_json_schema)
     if ARGS.verbose:
         eprint(json.dumps(json_schema, indent=4, sort_keys=True))
+    if ARGS.query_plan:
+        gen_query_plan_report(cql_compiler_path, cgsql_sources_dir,
+                              file_sql, out_dir, json_schema)
     package_dir = gen_swift_package(package_name, out_dir)
     generate_test_target = len(test_files) > 0
+    if runtime_package_dir:
+        gen_runtime_package(runtime_package_dir, cgsql_sources_dir)
     c_lib_name = make_c_lib(package_name, package_dir,
-                            cgsql_sources_dir, file_h, file_c, file_objc_h, generate_test_target)
+                            cgsql_sources_dir, file_h, file_c, file_objc_h, generate_test_target, runtime_package_dir)
     swift_file = Path(package_dir) / "Sources" / \
         package_name / f"{package_name}.swift"
     gen_swift_target(swift_code_generator_path,
                      file_json_schema, c_lib_name, swift_file)
+    remove_stale_files(swift_file.parent, {swift_file.name})
     gen_swift_test_target(package_name, package_dir, test_files)
     gen_read_me(package_name, package_dir)
+    if ARGS.depfile:
+        sources, headers = runtime_sources(cgsql_sources_dir)
+        dependencies = [file_sql, cql_compiler_path,
+                        swift_code_generator_path, Path(__file__)] + sources + headers + test_files
+        if ARGS.query_plan:
+            dependencies += query_plan_sources(cgsql_sources_dir)
+        # Generated files keep their modification time when their content
+        # doesn't change, so none of them can stand for the whole run. The
+        # depfile names a stamp file instead, which every run touches.
+        stamp = Path(out_dir) / f"{package_name}.stamp"
+        write_depfile(ARGS.depfile, stamp, dependencies)
+        stamp.touch()
 
 
 def initialize_output_dir(out_dir):
@@ -282,6 +722,27 @@ def initialize_output_dir(out_dir):
     out_path.mkdir(parents=True, exist_ok=True)
 
 
+def depfile_path(path):
+    # Paths inside the working directory are written relative to it, the
+    # way build systems name their inputs. Make requires spaces and '#' to be
+    # escaped, and '$' to be doubled.
+    path = Path(path).resolve(False)
+    try:
+        path = path.relative_to(Path.cwd())
+    except ValueError:
+        pass
+    return str(path).replace(' ', '\\ ').replace('#', '\\#').replace('$', '$$')
+
+
+def write_depfile(depfile, target, dependencies):
+    if ARGS.verbose:
+        eprint(f'Writing depfile {depfile}')
+    lines = [f'{depfile_path(target)}:']
+    for dependency in dict.fromkeys(depfile_path(d) for d in dependencies):
+        lines.append(f'  {dependency}')
+    write_if_changed(depfile, ' \\\n'.join(lines) + '\n')
+
+
 def usage(str):
     eprint(str)
     eprint("Use argument --help for detailed help.")
@@ -301,13 +762,21 @@ def main():
     file_sql = Path(ARGS.file_sql)
     if not file_sql.is_file():
         usage(f'sql input is not a file: {ARGS.file_sql}')
+    file_sql = file_sql.resolve(True)
     out_dir = Path(ARGS.out_dir).resolve(False)
     package_name = ARGS.package_name
     test_files = [] if ARGS.test_files is None else ARGS.test_files
+    runtime_package_dir = None
+    if ARGS.shared_runtime_dir:
+        runtime_package_dir = Path(ARGS.shared_runtime_dir).resolve(False)
 
     initialize_output_dir(out_dir)
-    gen_project(swift_code_generator_path, cql_compiler_path,
-                cgsql_sources_dir, file_sql, package_name, out_dir, test_files)
+    try:
+        gen_project(swift_code_generator_path, cql_compiler_path,
+                    cgsql_sources_dir, file_sql, package_name, out_dir, test_files, runtime_package_dir)
+    finally:
+        if ARGS.trace:
+            write_trace(ARGS.trace)
 
 
 if __name__ == "__main__":
@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 
+import functools
 import io
 import json
+import os
 import re
+import resource
 import sys
+import time
 from argparse import ArgumentParser
+from contextlib import contextmanager
 from pathlib import Path
 
 
@@ -14,6 +19,14 @@ def eprint(*args, **kwargs):
 
 def parse_args():
     parser = ArgumentParser()
+    parser.add_argument("--compact",
+                        action="store_true", dest="compact", default=False,
+                        help="Generate compact Swift code with single-line members.")
+    parser.add_argument("--depfile", dest="depfile", metavar="FILE",
+                        help="Write a Make-style dependency file listing the inputs of the generated Swift file.")
+    parser.add_argument("-e", "--export",
+                        action="store_true", dest="export", default=False,
+                        help="Generate methods that write query results as JSON Lines or CSV.")
     parser.add_argument("-i", "--input", dest="input",
                         help="Path to the input CG-SQL json file.", metavar="JSON_FILE", required=True)
     parser.add_argument("-m", "--module",
@@ -22,6 +35,13 @@ def parse_args():
                         help="A Swift module to import. Can be supplied multiple times.")
     parser.add_argument("-o", "--output", dest="output",
                         help="Path to the output generated Swift file.", metavar="SWIFT_FILE", required=True)
+    parser.add_argument("--share_row_types",
+                        action="store_true", dest="share_row_types", default=False,
+                        help="Queries with identical projections share a single row type.")
+    parser.add_argument("--size_report", dest="size_report", metavar="FILE",
+                        help="Write the generated code size of each proc, in lines and bytes, to this JSON file.")
+    parser.add_argument("--trace", dest="trace", metavar="FILE",
+                        help="Write per-phase timing to this file in Chrome trace-event JSON format.")
     parser.add_argument("-v", "--verbose",
                         action="store_true", dest="verbose", default=False,
                         help="print verbose status messages to stderr.")
@@ -31,7 +51,75 @@ def parse_args():
 
 ARGS = parse_args()
 
+TRACE_EVENTS = []
+
+
+def max_rss_bytes():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux.
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+@contextmanager
+def trace_phase(name, **trace_args):
+    if not ARGS.trace:
+        yield
+        return
+    # time.time() lines events up across processes; durations come from
+    # the monotonic clock so they can't be skewed by clock adjustments.
+    start_wall = time.time()
+    start_counter = time.perf_counter()
+    start_cpu = time.process_time()
+    start_rss = max_rss_bytes()
+    try:
+        yield
+    finally:
+        end_counter = time.perf_counter()
+        end_cpu = time.process_time()
+        end_rss = max_rss_bytes()
+        # ru_maxrss is a high-water mark over the life of the process, not a
+        # per-phase value. Report it as such, along with how much this phase
+        # raised it.
+        trace_args.update({
+            'cpu_ms': round((end_cpu - start_cpu) * 1000, 3),
+            'max_rss_so_far_bytes': end_rss,
+            'max_rss_growth_bytes': end_rss - start_rss,
+        })
+        TRACE_EVENTS.append({
+            'name': name,
+            'cat': 'SwiftGen',
+            'ph': 'X',
+            'pid': os.getpid(),
+            'tid': 0,
+            'ts': int(start_wall * 1e6),
+            'dur': int((end_counter - start_counter) * 1e6),
+            'args': trace_args,
+        })
+
+
+def traced(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        trace_args = {}
+        # Emitters take (out, proc); label their events with the proc name.
+        if len(args) > 1 and isinstance(args[1], dict) and 'name' in args[1]:
+            trace_args['proc'] = args[1]['name']
+        with trace_phase(func.__name__, **trace_args):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def write_trace(trace_path):
+    if ARGS.verbose:
+        eprint(f'Writing trace {trace_path}')
+    events = [{'name': 'process_name', 'ph': 'M', 'pid': os.getpid(),
+               'args': {'name': 'SwiftGen.py'}}]
+    events += TRACE_EVENTS
+    trace = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+    Path(trace_path).write_text(json.dumps(trace, indent=1))
+
 
+@traced
 def parse_json_schema(file_json):
     if ARGS.verbose:
         eprint(f'Parsing json schema')
@@ -83,6 +171,244 @@ PRIMITIVE_TYPE_TO_C_TYPE = {
 }
 
 
+# Generic helpers shared by the getters of --compact output. Each nullable
+# primitive getter passes its C accessors in, rather than spelling out the
+# null check and the result set bridging itself.
+COMPACT_HELPERS = """\
+@inline(__always)
+fileprivate func cqlColumn<R: AnyObject, T>(_ ref: Unmanaged<R>, _ row: Int32,
+    _ isNull: (R, Int32) -> Bool, _ value: (R, Int32) -> T) -> T? {
+    let resultSet = ref.takeUnretainedValue()
+    return isNull(resultSet, row) ? nil : value(resultSet, row)
+}
+
+@inline(__always)
+fileprivate func cqlColumn<R: AnyObject, T>(_ ref: Unmanaged<R>,
+    _ isNull: (R) -> Bool, _ value: (R) -> T) -> T? {
+    let resultSet = ref.takeUnretainedValue()
+    return isNull(resultSet) ? nil : value(resultSet)
+}
+"""
+
+# Streams result sets as JSON Lines or CSV for --export output. Cells are
+# read through the C getters and formatted straight into a reusable byte
+# buffer, which is written to the file handle whenever it fills up.
+EXPORT_HELPERS = """\
+fileprivate struct CQLExportWriter {
+    enum Format {
+        case jsonLines
+        case csv
+    }
+
+    private static let flushSize = 64 * 1024
+    private static let hexDigits: StaticString = "0123456789abcdef"
+    private static let base64Digits: StaticString =
+        "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+
+    private let handle: FileHandle
+    private let format: Format
+    private var buffer: [UInt8] = []
+    private var scratch = [UInt8](repeating: 0, count: 1024)
+    private var columnCount = 0
+
+    init(handle: FileHandle, format: Format) {
+        self.handle = handle
+        self.format = format
+        buffer.reserveCapacity(CQLExportWriter.flushSize + scratch.count)
+        // Make writes to a closed pipe fail with EPIPE, which flush() throws,
+        // instead of raising SIGPIPE, which terminates the process.
+        _ = fcntl(handle.fileDescriptor, F_SETNOSIGPIPE, 1)
+    }
+
+    mutating func header(_ names: StaticString...) {
+        guard format == .csv else { return }
+        for (i, name) in names.enumerated() {
+            if i > 0 { buffer.append(UInt8(ascii: ",")) }
+            append(name)
+        }
+        buffer.append(UInt8(ascii: "\\n"))
+    }
+
+    mutating func beginRow() {
+        columnCount = 0
+        if format == .jsonLines { buffer.append(UInt8(ascii: "{")) }
+    }
+
+    mutating func column(_ name: StaticString) {
+        if columnCount > 0 { buffer.append(UInt8(ascii: ",")) }
+        columnCount += 1
+        if format == .jsonLines {
+            buffer.append(UInt8(ascii: "\\""))
+            append(name)
+            buffer.append(UInt8(ascii: "\\""))
+            buffer.append(UInt8(ascii: ":"))
+        }
+    }
+
+    mutating func endRow() throws {
+        if format == .jsonLines { buffer.append(UInt8(ascii: "}")) }
+        buffer.append(UInt8(ascii: "\\n"))
+        if buffer.count >= CQLExportWriter.flushSize { try flush() }
+    }
+
+    mutating func flush() throws {
+        // Write through the descriptor so that write errors such as EPIPE or
+        // ENOSPC are thrown rather than raised as Objective-C exceptions.
+        let fd = handle.fileDescriptor
+        var written = 0
+        while written < buffer.count {
+            let result = buffer.withUnsafeBytes {
+                // Qualified, because the TextOutputStream conformance below
+                // adds a write(_:) member that hides the system call.
+                Darwin.write(fd, $0.baseAddress! + written, $0.count - written)
+            }
+            if result < 0 {
+                if errno == EINTR { continue }
+                throw POSIXError(POSIXErrorCode(rawValue: errno) ?? .EIO)
+            }
+            written += result
+        }
+        buffer.removeAll(keepingCapacity: true)
+    }
+
+    mutating func null() {
+        // CSV represents null as an empty field.
+        if format == .jsonLines { append("null") }
+    }
+
+    mutating func bool(_ value: Bool?) {
+        guard let value = value else { return null() }
+        if format == .jsonLines {
+            append(value ? "true" : "false")
+        } else {
+            buffer.append(value ? UInt8(ascii: "1") : UInt8(ascii: "0"))
+        }
+    }
+
+    mutating func int(_ value: Int64?) {
+        guard let value = value else { return null() }
+        if value < 0 { buffer.append(UInt8(ascii: "-")) }
+        var magnitude = value.magnitude
+        let start = buffer.count
+        repeat {
+            buffer.append(UInt8(ascii: "0") + UInt8(magnitude % 10))
+            magnitude /= 10
+        } while magnitude > 0
+        buffer[start...].reverse()
+    }
+
+    mutating func double(_ value: Double?) {
+        guard let value = value, value.isFinite else { return null() }
+        // Swift prints the shortest representation that round-trips, and
+        // hands it to _writeASCII below without creating a String.
+        value.write(to: &self)
+    }
+
+    mutating func text(_ value: Unmanaged<CFString>?) throws {
+        try text(value?.takeUnretainedValue())
+    }
+
+    mutating func text(_ value: CFString?) throws {
+        guard let value = value else { return null() }
+        buffer.append(UInt8(ascii: "\\""))
+        let encoding = CFStringBuiltInEncodings.UTF8.rawValue
+        if let cString = CFStringGetCStringPtr(value, encoding) {
+            let count = strlen(cString)
+            cString.withMemoryRebound(to: UInt8.self, capacity: count) {
+                appendEscaped(UnsafeBufferPointer(start: $0, count: count))
+            }
+        } else {
+            // Transcode through the scratch buffer. It is moved out of self
+            // while in use, so it can be read while appending to the buffer.
+            var chunk: [UInt8] = []
+            swap(&chunk, &scratch)
+            defer { swap(&chunk, &scratch) }
+            var range = CFRange(location: 0, length: CFStringGetLength(value))
+            while range.length > 0 {
+                var used: CFIndex = 0
+                let converted = chunk.withUnsafeMutableBufferPointer {
+                    CFStringGetBytes(value, range, encoding, UInt8(ascii: "?"), false,
+                        $0.baseAddress, $0.count, &used)
+                }
+                // Unconvertible characters become "?", so no progress means
+                // the string cannot be exported at all.
+                if converted == 0 { throw CocoaError(.fileWriteInapplicableStringEncoding) }
+                chunk.withUnsafeBufferPointer {
+                    appendEscaped(UnsafeBufferPointer(rebasing: $0.prefix(used)))
+                }
+                range.location += converted
+                range.length -= converted
+            }
+        }
+        buffer.append(UInt8(ascii: "\\""))
+    }
+
+    mutating func blob(_ value: Unmanaged<CFData>?) {
+        blob(value?.takeUnretainedValue())
+    }
+
+    mutating func blob(_ value: CFData?) {
+        guard let value = value else { return null() }
+        let bytes = UnsafeBufferPointer(start: CFDataGetBytePtr(value), count: CFDataGetLength(value))
+        let digits = CQLExportWriter.base64Digits.utf8Start
+        if format == .jsonLines { buffer.append(UInt8(ascii: "\\"")) }
+        var i = 0
+        while i < bytes.count {
+            let remaining = bytes.count - i
+            var n = UInt32(bytes[i]) << 16
+            if remaining > 1 { n |= UInt32(bytes[i + 1]) << 8 }
+            if remaining > 2 { n |= UInt32(bytes[i + 2]) }
+            buffer.append(digits[Int(n >> 18 & 63)])
+            buffer.append(digits[Int(n >> 12 & 63)])
+            buffer.append(remaining > 1 ? digits[Int(n >> 6 & 63)] : UInt8(ascii: "="))
+            buffer.append(remaining > 2 ? digits[Int(n & 63)] : UInt8(ascii: "="))
+            i += 3
+        }
+        if format == .jsonLines { buffer.append(UInt8(ascii: "\\"")) }
+    }
+
+    private mutating func append(_ text: StaticString) {
+        buffer.append(contentsOf: UnsafeBufferPointer(start: text.utf8Start, count: text.utf8CodeUnitCount))
+    }
+
+    // Text is always quoted, so only quotes, and for JSON backslashes and
+    // control characters, need escaping.
+    private mutating func appendEscaped(_ bytes: UnsafeBufferPointer<UInt8>) {
+        let hexDigits = CQLExportWriter.hexDigits.utf8Start
+        for byte in bytes {
+            switch format {
+            case .jsonLines:
+                if byte == UInt8(ascii: "\\"") || byte == UInt8(ascii: "\\\\") {
+                    buffer.append(UInt8(ascii: "\\\\"))
+                    buffer.append(byte)
+                } else if byte < 0x20 {
+                    append("\\\\u00")
+                    buffer.append(hexDigits[Int(byte >> 4)])
+                    buffer.append(hexDigits[Int(byte & 0xf)])
+                } else {
+                    buffer.append(byte)
+                }
+            case .csv:
+                if byte == UInt8(ascii: "\\"") { buffer.append(byte) }
+                buffer.append(byte)
+            }
+        }
+    }
+}
+
+extension CQLExportWriter: TextOutputStream {
+    mutating func write(_ string: String) {
+        var string = string
+        string.withUTF8 { buffer.append(contentsOf: $0) }
+    }
+
+    mutating func _writeASCII(_ bytes: UnsafeBufferPointer<UInt8>) {
+        buffer.append(contentsOf: bytes)
+    }
+}
+"""
+
+
 def cast_primitive_type_to_c_type(ty, swift_name):
     return f"{PRIMITIVE_TYPE_TO_C_TYPE[ty]}({swift_name})"
 
@@ -193,6 +519,11 @@ def gen_swift_query_projection_column_getter(out, c_query_name, column, has_row)
         eprint(
             f'Generating swift query projection column getter {col.swift_name()} for {c_query_name}')
 
+    if ARGS.compact:
+        gen_compact_swift_query_projection_column_getter(
+            out, c_query_name, col, has_row)
+        return
+
     out.write(f'public var {col.swift_arg_declaration()} {{\n')
     ty = column['type']
     row_arg = ', row' if has_row else ''
@@ -219,7 +550,24 @@ def gen_swift_query_projection_column_getter(out, c_query_name, column, has_row)
     out.write('}\n')
 
 
-def gen_swift_fetcher_init(out, query, single_result):
+def gen_compact_swift_query_projection_column_getter(out, c_query_name, col, has_row):
+    ty = col.arg['type']
+    row_arg = ', row' if has_row else ''
+    result_set = 'resultSet.result_set' if has_row else 'result_set'
+    getter = f'{c_query_name}_get_{col.c_name()}'
+    if col.is_nullable() and ty not in ['text', 'blob', 'object']:
+        body = f'cqlColumn({c_query_name}_from_CGS_{c_query_name}({result_set}){row_arg}, {getter}_is_null, {getter}_value)'
+    else:
+        body = f'CGS_{getter}({result_set}{row_arg})'
+        if col.is_nullable() and ty == 'text':
+            body += ' as String?'
+        elif col.is_nullable() and ty == 'blob':
+            body += ' as Data?'
+    out.write(f'public var {col.swift_arg_declaration()} {{ {body} }}\n')
+
+
+@traced
+def gen_swift_fetcher_init(out, query, single_result, shared_row_query=None):
     c_query_name = query["name"]
     temp = io.StringIO()
     init_proc = query.copy()
@@ -242,6 +590,11 @@ def gen_swift_fetcher_init(out, query, single_result):
     #
     # [1] is '?' if single_result
     # [2] only present if single_result_set
+    #
+    # If the query shares the rows of shared_row_query, the result set is
+    # instead wrapped in that query's struct:
+    #       rows = SHARED_SWIFT_NAME(result_set: CGS_SHARED_NAME_from_SHARED_NAME(
+    #           unsafeBitCast(result_set_ref!.takeUnretainedValue(), to: SHARED_NAME_result_set_ref.self)))
 
     q = '?' if single_result else ''
     query_proc[0] = query_proc[0].replace(
@@ -269,8 +622,14 @@ def gen_swift_fetcher_init(out, query, single_result):
             raise ValueError(
                 f'Could not generate swift initializer for query {c_query_name}')
 
-    query_proc.insert(
-        call_line+1, f'    result_set = CGS_{c_query_name}_from_{c_query_name}(result_set_ref!.takeUnretainedValue())')
+    if shared_row_query:
+        c_shared_name = shared_row_query["name"]
+        swift_shared_name = swift_name(c_shared_name, True)
+        query_proc.insert(
+            call_line+1, f'    rows = {swift_shared_name}(result_set: CGS_{c_shared_name}_from_{c_shared_name}(unsafeBitCast(result_set_ref!.takeUnretainedValue(), to: {c_shared_name}_result_set_ref.self)))')
+    else:
+        query_proc.insert(
+            call_line+1, f'    result_set = CGS_{c_query_name}_from_{c_query_name}(result_set_ref!.takeUnretainedValue())')
     query_proc.insert(
         call_line+2, '    cql_release(result_set_ref!.takeUnretainedValue())')
     if single_result:
@@ -281,7 +640,8 @@ def gen_swift_fetcher_init(out, query, single_result):
     out.write(''.join(query_proc))
 
 
-def gen_swift_query(out, query):
+@traced
+def gen_swift_query(out, query, shared_row_query=None):
     c_query_name = query["name"]
     swift_query_name = swift_name(c_query_name, True)
 
@@ -290,8 +650,28 @@ def gen_swift_query(out, query):
 
     if lookup(query, "hasOutResult"):
         gen_swift_single_result_query(out, query)
+    elif shared_row_query and shared_row_query is not query:
+        gen_swift_shared_row_query(out, query, shared_row_query)
     else:
-        gen_swift_multi_result_query(out, query)
+        gen_swift_multi_result_query(
+            out, query, shared_row_query is query)
+
+
+def find_shared_row_queries(queries):
+    """Maps the name of each multi-result query whose projection is identical
+    to that of another query to the first such query in schema order."""
+    groups = {}
+    for query in queries:
+        if lookup(query, "hasOutResult"):
+            continue
+        key = json.dumps(query["projection"], sort_keys=True)
+        groups.setdefault(key, []).append(query)
+    shared_row_queries = {}
+    for group in groups.values():
+        if len(group) > 1:
+            for query in group:
+                shared_row_queries[query["name"]] = group[0]
+    return shared_row_queries
 
 
 def indent_text(text, indent_spaces):
@@ -309,6 +689,7 @@ def gen_projection_getters(out, query, use_row):
     out.write(indent_text(temp.getvalue(), indent_count))
 
 
+@traced
 def gen_swift_single_result_query(out, query):
     c_query_name = query["name"]
     swift_query_name = swift_name(c_query_name, True)
@@ -320,18 +701,24 @@ def gen_swift_single_result_query(out, query):
     out.write('\n')
 
     out.write('    // Hashable\n')
-    out.write(
-        f'    public static func == (lhs: {swift_query_name}, rhs: {swift_query_name}) -> Bool {{\n')
-    out.write(
-        f'        CGS_{c_query_name}_equal(lhs.result_set,\n')
-    out.write(
-        '            rhs.result_set)\n')
-    out.write('    }\n')
-    out.write('\n')
-    out.write('    public func hash(into hasher: inout Hasher) {\n')
-    out.write(
-        f'        hasher.combine(CGS_{c_query_name}_hash(result_set))\n')
-    out.write('    }\n')
+    if ARGS.compact:
+        out.write(
+            f'    public static func == (lhs: {swift_query_name}, rhs: {swift_query_name}) -> Bool {{ CGS_{c_query_name}_equal(lhs.result_set, rhs.result_set) }}\n')
+        out.write(
+            f'    public func hash(into hasher: inout Hasher) {{ hasher.combine(CGS_{c_query_name}_hash(result_set)) }}\n')
+    else:
+        out.write(
+            f'    public static func == (lhs: {swift_query_name}, rhs: {swift_query_name}) -> Bool {{\n')
+        out.write(
+            f'        CGS_{c_query_name}_equal(lhs.result_set,\n')
+        out.write(
+            '            rhs.result_set)\n')
+        out.write('    }\n')
+        out.write('\n')
+        out.write('    public func hash(into hasher: inout Hasher) {\n')
+        out.write(
+            f'        hasher.combine(CGS_{c_query_name}_hash(result_set))\n')
+        out.write('    }\n')
     out.write('\n')
 
     out.write(
@@ -343,7 +730,8 @@ def gen_swift_single_result_query(out, query):
     out.write('\n')
 
 
-def gen_swift_multi_result_query(out, query):
+@traced
+def gen_swift_multi_result_query(out, query, shares_rows=False):
     c_query_name = query["name"]
     swift_query_name = swift_name(c_query_name, True)
 
@@ -358,40 +746,180 @@ def gen_swift_multi_result_query(out, query):
     out.write('\n')
 
     out.write('        // Hashable\n')
+    if ARGS.compact:
+        # Not routed through a shared protocol: its witnesses have to spell
+        # out the CGS_ types and C functions for every row type, which comes
+        # out larger than these one-liners.
+        out.write(
+            f'        public static func == (lhs: Element, rhs: Element) -> Bool {{ CGS_{c_query_name}_row_equal(lhs.resultSet.result_set, lhs.row, rhs.resultSet.result_set, rhs.row) }}\n')
+        out.write(
+            f'        public func hash(into hasher: inout Hasher) {{ hasher.combine(CGS_{c_query_name}_row_hash(resultSet.result_set, row)) }}\n')
+        out.write('    }\n')
+        out.write('\n')
+        out.write('    // RandomAccessCollection\n')
+        out.write(
+            '    public subscript(index: Int32) -> Element { Element(resultSet:self, row:index) }\n')
+        out.write('    public var startIndex : Int32 { 0 }\n')
+        out.write(
+            f'    public var endIndex : Int32 {{ CGS_{c_query_name}_result_count(result_set) }}\n')
+        out.write('\n')
+    else:
+        out.write(
+            '        public static func == (lhs: Element, rhs: Element) -> Bool {\n')
+        out.write(
+            f'            CGS_{c_query_name}_row_equal(lhs.resultSet.result_set, lhs.row,\n')
+        out.write(
+            '                rhs.resultSet.result_set, rhs.row)\n')
+        out.write('        }\n')
+        out.write('\n')
+        out.write('        public func hash(into hasher: inout Hasher) {\n')
+        out.write(
+            f'            hasher.combine(CGS_{c_query_name}_row_hash(resultSet.result_set, row))\n')
+        out.write('        }\n')
+        out.write('\n')
+        out.write('    }\n')
+        out.write('\n')
+        out.write('    // RandomAccessCollection\n')
+        out.write('    public subscript(index: Int32) -> Element {\n')
+        out.write('        get { Element(resultSet:self, row:index) }\n')
+        out.write('    }\n')
+        out.write('\n')
+        out.write('    public var startIndex : Int32 { 0 }\n')
+        out.write('    public var endIndex : Int32 {\n')
+        out.write(f'        CGS_{c_query_name}_result_count(result_set)\n')
+        out.write('    }\n')
+        out.write('\n')
+
+    if ARGS.export and is_exportable(query):
+        gen_swift_export(out, query)
+
+    out.write(f'    private var result_set: CGS_{c_query_name}!\n')
+
+    out.write('\n')
+    if shares_rows:
+        # Used by the queries that share this query's rows.
+        out.write(
+            f'    fileprivate init(result_set: CGS_{c_query_name}) {{\n')
+        out.write('        self.result_set = result_set\n')
+        out.write('    }\n')
+        out.write('\n')
+    gen_swift_fetcher_init(out, query, False)
+    out.write('}\n')
+    out.write('\n')
+
+
+def is_exportable(query):
+    return all(column['type'] != 'object' for column in query["projection"])
+
+
+EXPORT_WRITER_METHOD = {
+    'bool': 'bool',
+    'integer': 'int',
+    'long': 'int',
+    'real': 'double',
+    'text': 'text',
+    'blob': 'blob',
+}
+
+
+def gen_swift_export_column(out, c_query_name, column):
+    col = Arg(column)
+    ty = column['type']
+    method = EXPORT_WRITER_METHOD[ty]
+    getter = f'{c_query_name}_get_{col.c_name()}'
+    if ty in ['text', 'blob']:
+        # The text and blob writers handle nil themselves.
+        value = f'{getter}(resultSet, row)'
+    elif col.is_nullable():
+        value = f'{getter}_value(resultSet, row)'
+    else:
+        value = f'{getter}(resultSet, row)'
+    if ty == 'integer':
+        value = f'Int64({value})'
+    if col.is_nullable() and ty not in ['text', 'blob']:
+        value = f'{getter}_is_null(resultSet, row) ? nil : {value}'
+    out.write(f'            writer.column("{col.c_name()}")\n')
+    call = 'try ' if ty == 'text' else ''
+    out.write(f'            {call}writer.{method}({value})\n')
+
+
+@traced
+def gen_swift_export(out, query):
+    c_query_name = query["name"]
+    column_names = ', '.join(
+        [f'"{column["name"]}"' for column in query["projection"]])
+
+    out.write('    // Export\n')
+    out.write('    public func writeJSONLines(to handle: FileHandle) throws {\n')
     out.write(
-        '        public static func == (lhs: Element, rhs: Element) -> Bool {\n')
-    out.write(
-        f'            CGS_{c_query_name}_row_equal(lhs.resultSet.result_set, lhs.row,\n')
+        '        var writer = CQLExportWriter(handle: handle, format: .jsonLines)\n')
+    out.write('        try export(to: &writer)\n')
+    out.write('    }\n')
+    out.write('\n')
+    out.write('    public func writeCSV(to handle: FileHandle) throws {\n')
     out.write(
-        '                rhs.resultSet.result_set, rhs.row)\n')
-    out.write('        }\n')
+        '        var writer = CQLExportWriter(handle: handle, format: .csv)\n')
+    out.write(f'        writer.header({column_names})\n')
+    out.write('        try export(to: &writer)\n')
+    out.write('    }\n')
     out.write('\n')
-    out.write('        public func hash(into hasher: inout Hasher) {\n')
+    out.write('    private func export(to writer: inout CQLExportWriter) throws {\n')
     out.write(
-        f'            hasher.combine(CGS_{c_query_name}_row_hash(resultSet.result_set, row))\n')
+        f'        let resultSet = {c_query_name}_from_CGS_{c_query_name}(result_set).takeUnretainedValue()\n')
+    out.write('        for row in startIndex..<endIndex {\n')
+    out.write('            writer.beginRow()\n')
+    for column in query["projection"]:
+        gen_swift_export_column(out, c_query_name, column)
+    out.write('            try writer.endRow()\n')
     out.write('        }\n')
-    out.write('\n')
+    out.write('        try writer.flush()\n')
     out.write('    }\n')
     out.write('\n')
+
+
+@traced
+def gen_swift_shared_row_query(out, query, shared_row_query):
+    c_query_name = query["name"]
+    swift_query_name = swift_name(c_query_name, True)
+    swift_shared_name = swift_name(shared_row_query["name"], True)
+
+    # CQL lays out the rows of identical projections identically, so the
+    # result set can be read through the shared query's accessors as is.
+    out.write(
+        f'public struct {swift_query_name} : RandomAccessCollection {{\n')
+    out.write(f'    public typealias Element = {swift_shared_name}.Element\n')
+    out.write('\n')
     out.write('    // RandomAccessCollection\n')
     out.write('    public subscript(index: Int32) -> Element {\n')
-    out.write('        get { Element(resultSet:self, row:index) }\n')
+    out.write('        get { rows[index] }\n')
     out.write('    }\n')
     out.write('\n')
     out.write('    public var startIndex : Int32 { 0 }\n')
     out.write('    public var endIndex : Int32 {\n')
-    out.write(f'        CGS_{c_query_name}_result_count(result_set)\n')
+    out.write('        rows.endIndex\n')
     out.write('    }\n')
     out.write('\n')
 
-    out.write(f'    private var result_set: CGS_{c_query_name}!\n')
+    if ARGS.export and is_exportable(query):
+        out.write('    // Export\n')
+        out.write('    public func writeJSONLines(to handle: FileHandle) throws {\n')
+        out.write('        try rows.writeJSONLines(to: handle)\n')
+        out.write('    }\n')
+        out.write('\n')
+        out.write('    public func writeCSV(to handle: FileHandle) throws {\n')
+        out.write('        try rows.writeCSV(to: handle)\n')
+        out.write('    }\n')
+        out.write('\n')
+
+    out.write(f'    private var rows: {swift_shared_name}!\n')
 
     out.write('\n')
-    gen_swift_fetcher_init(out, query, False)
+    gen_swift_fetcher_init(out, query, False, shared_row_query)
     out.write('}\n')
     out.write('\n')
 
 
+@traced
 def gen_swift_simple_proc(out, proc):
     c_proc_name = proc["name"]
     swift_proc_name = swift_name(c_proc_name)
@@ -434,16 +962,15 @@ def gen_swift_proc(out, proc):
         gen_swift_simple_proc(out, proc)
 
 
+@traced
 def gen_swift_code(json_schema, modules, swift_path):
     if ARGS.verbose:
-        eprint(f'Generating swift code {swift_file}')
+        eprint(f'Generating swift code {swift_path}')
 
     out = io.StringIO()
     out.write('import Foundation\n')
     out.write('\n')
-    modules = modules.copy()
-    modules.sort()
-    for module in modules:
+    for module in sorted(modules or []):
         out.write(f'import {module}\n')
     out.write('\n')
     out.write('fileprivate func check(_ code: Int32) throws {\n')
@@ -452,29 +979,94 @@ def gen_swift_code(json_schema, modules, swift_path):
     out.write('    }\n')
     out.write('}\n')
     out.write('\n')
+    if ARGS.compact:
+        out.write(COMPACT_HELPERS)
+        out.write('\n')
+    if ARGS.export:
+        out.write(EXPORT_HELPERS)
+        out.write('\n')
+
+    sizes = []
+
+    def gen_sized(gen, proc, *args):
+        temp = io.StringIO()
+        gen(temp, proc, *args)
+        text = temp.getvalue()
+        sizes.append({
+            'name': proc['name'],
+            'lines': text.count('\n'),
+            'bytes': len(text.encode('utf-8')),
+        })
+        out.write(text)
 
     for proc in json_schema["general"]:
-        gen_swift_proc(out, proc)
+        gen_sized(gen_swift_proc, proc)
         out.write('\n')
 
     for proc in json_schema["inserts"]:
-        gen_swift_proc(out, proc)
+        gen_sized(gen_swift_proc, proc)
         out.write('\n')
 
     for proc in json_schema["updates"]:
-        gen_swift_proc(out, proc)
+        gen_sized(gen_swift_proc, proc)
         out.write('\n')
 
     for proc in json_schema["deletes"]:
-        gen_swift_proc(out, proc)
+        gen_sized(gen_swift_proc, proc)
         out.write('\n')
 
+    shared_row_queries = {}
+    if ARGS.share_row_types:
+        shared_row_queries = find_shared_row_queries(json_schema["queries"])
+
     for i, query in enumerate(json_schema["queries"]):
         if i > 0:
             out.write('\n')
-        gen_swift_query(out, query)
+        gen_sized(gen_swift_query, query,
+                  shared_row_queries.get(query["name"]))
+
+    code = out.getvalue()
+    with trace_phase('write_swift_file'):
+        # Leave an up to date file untouched, so that build systems that
+        # compare modification times don't rebuild its dependents.
+        if not swift_path.is_file() or swift_path.read_text() != code:
+            swift_path.write_text(code)
+    return {
+        'procs': sizes,
+        'total': {
+            'lines': code.count('\n'),
+            'bytes': len(code.encode('utf-8')),
+        },
+    }
+
+
+def write_size_report(size_report, size_report_path):
+    if ARGS.verbose:
+        eprint(f'Writing size report {size_report_path}')
+        for proc in size_report['procs']:
+            eprint(f"{proc['name']}: {proc['lines']} lines, {proc['bytes']} bytes")
+    Path(size_report_path).write_text(json.dumps(size_report, indent=4))
 
-    swift_path.write_text(out.getvalue())
+
+def depfile_path(path):
+    # Paths inside the working directory are written relative to it, the
+    # way build systems name their inputs. Make requires spaces and '#' to be
+    # escaped, and '$' to be doubled.
+    path = Path(path).resolve(False)
+    try:
+        path = path.relative_to(Path.cwd())
+    except ValueError:
+        pass
+    return str(path).replace(' ', '\\ ').replace('#', '\\#').replace('$', '$$')
+
+
+def write_depfile(depfile, target, dependencies):
+    if ARGS.verbose:
+        eprint(f'Writing depfile {depfile}')
+    lines = [f'{depfile_path(target)}:']
+    for dependency in dict.fromkeys(depfile_path(d) for d in dependencies):
+        lines.append(f'  {dependency}')
+    Path(depfile).write_text(' \\\n'.join(lines) + '\n')
 
 
 def usage(str):
@@ -491,10 +1083,19 @@ def main():
     if not json_path.is_file():
         usage(f'JSON input is not a file: {ARGS.input}')
 
-    json_schema = parse_json_schema(json_path)
-
-    swift_path = Path(ARGS.output).resolve(False)
-    gen_swift_code(json_schema, ARGS.modules, swift_path)
+    try:
+        json_schema = parse_json_schema(json_path)
+
+        swift_path = Path(ARGS.output).resolve(False)
+        size_report = gen_swift_code(json_schema, ARGS.modules, swift_path)
+        if ARGS.size_report:
+            write_size_report(size_report, ARGS.size_report)
+        if ARGS.depfile:
+            write_depfile(ARGS.depfile, swift_path,
+                          [json_path, Path(__file__)])
+    finally:
+        if ARGS.trace:
+            write_trace(ARGS.trace)
 
 
 if __name__ == "__main__":
@@ -23,10 +23,61 @@ OUT_DIR=out
 rm -rf "$OUT_DIR"
 
 "$PACKAGEGEN" -c "$CQL" -d "$CGSQL_SOURCES" --in tests/TestGen/TestGen.sql -o "$OUT_DIR" -p TestGen -s "$SWIFTGEN" -t tests/TestGen/TestGenTests.swift
+
+# Regenerating an up to date package must not touch any of its files.
+
+touch "$OUT_DIR/marker"
+sleep 1
+"$PACKAGEGEN" -c "$CQL" -d "$CGSQL_SOURCES" --in tests/TestGen/TestGen.sql -o "$OUT_DIR" -p TestGen -s "$SWIFTGEN" -t tests/TestGen/TestGenTests.swift
+CHANGED=$(find "$OUT_DIR" -newer "$OUT_DIR/marker")
+if [ -n "$CHANGED" ]; then
+  echo "Regeneration modified files: $CHANGED"
+  exit 1
+fi
+rm "$OUT_DIR/marker"
+
+# The generated package must not depend on where it is generated from.
+
+(cd tests && "../$PACKAGEGEN" -c "../$CQL" -d "../$CGSQL_SOURCES" --in TestGen/TestGen.sql -o "../$OUT_DIR/relocated" -p TestGen -s "../$SWIFTGEN" -t TestGen/TestGenTests.swift)
+diff -r "$OUT_DIR"/TestGen "$OUT_DIR"/relocated/TestGen
+
 pushd "$OUT_DIR"/TestGen
 swift test
 popd
 
+# Audit TestGen's query plans. a_with_args filters with instr(), which no
+# index can serve, so it must be reported as a table scan.
+
+"$PACKAGEGEN" -c "$CQL" -d "$CGSQL_SOURCES" --in tests/TestGen/TestGen.sql -o "$OUT_DIR/query_plan" -p TestGen -s "$SWIFTGEN" -q
+python3 - "$OUT_DIR/query_plan/TestGen_query_plan_report.json" <<'END'
+import json
+import sys
+
+with open(sys.argv[1]) as f:
+    report = json.load(f)
+entries = report['procs']['a_with_args']
+kinds = [alert['kind'] for entry in entries for alert in entry['alerts']]
+if 'tableScan' not in kinds:
+    sys.exit(f'Expected a tableScan alert for a_with_args, got {entries}')
+END
+
+# Build TestGen again with the optional code generation features enabled.
+# Generate over a package made without them first, to check that files
+# from the earlier run are removed.
+
+"$PACKAGEGEN" -c "$CQL" -d "$CGSQL_SOURCES" --in tests/TestGen/TestGen.sql -o "$OUT_DIR/options" -p TestGen -s "$SWIFTGEN" -t tests/TestGen/TestGenTests.swift
+
+"$PACKAGEGEN" -c "$CQL" -d "$CGSQL_SOURCES" --in tests/TestGen/TestGen.sql -o "$OUT_DIR/options" -p TestGen -s "$SWIFTGEN" -t tests/TestGen/TestGenTests.swift \
+  -t tests/TestGen/TestGenSharedRowsTests.swift -t tests/TestGen/TestGenExportTests.swift \
+  -r "$OUT_DIR/CQLRuntime" --compact --share_row_types --export
+if [ -e "$OUT_DIR"/options/TestGen/Sources/libTestGen/cqlrt_common.c ]; then
+  echo "Stale runtime sources left in $OUT_DIR/options/TestGen"
+  exit 1
+fi
+pushd "$OUT_DIR"/options/TestGen
+swift test
+popd
+
 # Also build examples
 
 "$PACKAGEGEN" -c "$CQL" -d "$CGSQL_SOURCES" --in examples/Todo/Todo.sql -o "$OUT_DIR" -p Todo -s "$SWIFTGEN" -t examples/Todo/TodoTests.swift
@@ -0,0 +1,68 @@
+import XCTest
+import TestGen
+
+import SQLite3
+
+// Run against a package generated with --export.
+final class TestGenExportTests: XCTestCase {
+    var db: OpaquePointer!
+
+    override func setUpWithError() throws {
+        let rc = sqlite3_open(":memory:", &db)
+        XCTAssertEqual(rc, SQLITE_OK)
+        try todoCreateTables(db:db)
+
+        try bAdd(db:db, t: "say \"hi\"\nbye", b: true, i: -17, l: 77, r: 0.5, bl: "Hi".data(using: .utf8)!)
+        try bAdd(db:db, t: nil, b: nil, i: nil, l: nil, r: nil, bl: nil)
+    }
+
+    override func tearDown() {
+        sqlite3_close(db)
+    }
+
+    func export(_ write: (FileHandle) throws -> Void) throws -> String {
+        let url = FileManager.default.temporaryDirectory
+            .appendingPathComponent(UUID().uuidString)
+        XCTAssertTrue(FileManager.default.createFile(atPath: url.path, contents: nil))
+        defer { try? FileManager.default.removeItem(at: url) }
+
+        let handle = try FileHandle(forWritingTo: url)
+        try write(handle)
+        handle.closeFile()
+        return String(decoding: try Data(contentsOf: url), as: UTF8.self)
+    }
+
+    func testWriteJSONLines() throws {
+        let all = try AllB(db:db)
+        let text = try export { try all.writeJSONLines(to: $0) }
+        XCTAssertEqual(text, """
+            {"rowid":1,"t":"say \\"hi\\"\\u000abye","b":true,"i":-17,"l":77,"r":0.5,"bl":"SGk="}
+            {"rowid":2,"t":null,"b":null,"i":null,"l":null,"r":null,"bl":null}
+
+            """)
+    }
+
+    func testWriteCSV() throws {
+        let all = try AllB(db:db)
+        let text = try export { try all.writeCSV(to: $0) }
+        XCTAssertEqual(text, """
+            rowid,t,b,i,l,r,bl
+            1,"say ""hi""
+            bye",1,-17,77,0.5,SGk=
+            2,,,,,,
+
+            """)
+    }
+
+    func testShortestDoubles() throws {
+        for r in [3.14159, 0.1, 100.0] {
+            try aAdd(db:db, t:"", b:false, i:0, l:0, r:r, bl:Data())
+        }
+        let all = try AllA(db:db)
+        let text = try export { try all.writeCSV(to: $0) }
+        let r = text.split(separator: "\n").dropFirst().map {
+            $0.split(separator: ",", omittingEmptySubsequences: false)[5]
+        }
+        XCTAssertEqual(r, ["3.14159", "0.1", "100.0"])
+    }
+}
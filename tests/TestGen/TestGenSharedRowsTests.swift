@@ -0,0 +1,49 @@
+import XCTest
+import TestGen
+
+import SQLite3
+
+// Run against a package generated with --share_row_types.
+final class TestGenSharedRowsTests: XCTestCase {
+    func testSharedRows() throws {
+        var db: OpaquePointer!
+        let rc = sqlite3_open(":memory:", &db)
+        XCTAssertEqual(rc, SQLITE_OK)
+        defer { sqlite3_close(db) }
+        try todoCreateTables(db:db)
+
+        let blob = "Hi!".data(using: .utf8)!
+        for t in ["Buy milk", "Walk dog", "Write code"] {
+            try aAdd(db:db, t:t, b: false, i: 17, l: 77, r: 3.14159, bl: blob)
+        }
+
+        let all = try AllA(db:db)
+        // instr(t, '') is 1 for every row, so this selects every row too.
+        let withArgs = try AWithArgs(db:db, t:"", b:nil, i:nil, l:nil, r:nil, bl:nil,
+                                     t2:"", b2:false, i2:0, l2:0, r2:0, bl2:Data())
+        XCTAssertEqual(all.count, 3)
+        XCTAssertEqual(withArgs.count, all.count)
+
+        // Both queries have the same row type, so their rows compare directly.
+        let first: AllA.Element = withArgs[0]
+        XCTAssertEqual(first, all[0])
+        XCTAssertEqual(Array(withArgs), Array(all))
+        XCTAssertNotEqual(withArgs[0], all[1])
+        XCTAssertEqual(Set(withArgs), Set(all))
+
+        for (row, sharedRow) in zip(all, withArgs) {
+            XCTAssertEqual(sharedRow.rowid, row.rowid)
+            XCTAssertEqual(sharedRow.t, row.t)
+            XCTAssertEqual(sharedRow.b, row.b)
+            XCTAssertEqual(sharedRow.i, row.i)
+            XCTAssertEqual(sharedRow.l, row.l)
+            XCTAssertEqual(sharedRow.r, row.r)
+            XCTAssertEqual(sharedRow.bl, row.bl)
+        }
+
+        let filtered = try AWithArgs(db:db, t:"Walk", b:nil, i:nil, l:nil, r:nil, bl:nil,
+                                     t2:"", b2:false, i2:0, l2:0, r2:0, bl2:Data())
+        XCTAssertEqual(Array(filtered), [all[1]])
+        XCTAssertEqual(filtered[0].t, "Walk dog")
+    }
+}